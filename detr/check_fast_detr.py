@@ -0,0 +1,99 @@
+'''
+Checks the fast_detr rewrites against the DETR / torch reference modules on
+CPU. Run from this directory: python check_fast_detr.py
+'''
+import copy
+import sys
+from types import SimpleNamespace
+
+sys.path.append("./DETR")
+import torch
+from torch import nn
+
+from DETR.models.position_encoding import PositionEmbeddingSine
+from DETR.models.transformer import Transformer
+from DETR.util.misc import NestedTensor
+from fast_detr import (drop_aux_outputs, fuse_input_normalization,
+                       use_fast_position_embedding, use_sdpa)
+from inference_data import FUSED_BORDER, IMAGENET_MEAN, IMAGENET_STD
+
+torch.manual_seed(0)
+
+# * SDPAMultiheadAttention vs nn.MultiheadAttention
+ref_attn = nn.MultiheadAttention(256, 8).eval()
+sdpa_attn = use_sdpa(nn.Sequential(copy.deepcopy(ref_attn)))[0]
+query = torch.randn(100, 2, 256)
+memory = torch.randn(300, 2, 256)
+key_padding_mask = torch.zeros(2, 300, dtype=torch.bool)
+key_padding_mask[1, 200:] = True
+with torch.no_grad():
+    for q, kv in ((memory, memory), (query, memory)):
+        ref = ref_attn(q, kv, kv, key_padding_mask=key_padding_mask)[0]
+        out = sdpa_attn(q, kv, kv, key_padding_mask=key_padding_mask)[0]
+        print(f'sdpa max abs diff : {(ref - out).abs().max():.2e}')
+        assert torch.allclose(ref, out, atol=1e-5)
+
+# * FastPositionEmbeddingSine vs PositionEmbeddingSine, with padded images
+ref_pos = PositionEmbeddingSine(128, normalize=True)
+# use_fast_position_embedding takes the device from the model's parameters
+fast_pos = use_fast_position_embedding(
+    nn.Sequential(nn.Linear(1, 1), copy.deepcopy(ref_pos)))[1]
+features = torch.randn(2, 2048, 20, 25)
+mask = torch.zeros(2, 20, 25, dtype=torch.bool)
+mask[0, 14:, :] = True
+mask[1, :, 17:] = True
+with torch.no_grad():
+    ref = ref_pos(NestedTensor(features, mask))
+    out = fast_pos(NestedTensor(features, mask))
+print(f'pos max abs diff : {(ref - out).abs().max():.2e}')
+assert torch.allclose(ref, out, atol=1e-5)
+
+# * drop_aux_outputs vs the last layer of the intermediate decoder outputs
+transformer = Transformer(d_model=64,
+                          nhead=4,
+                          num_encoder_layers=2,
+                          num_decoder_layers=3,
+                          dim_feedforward=128,
+                          return_intermediate_dec=True).eval()
+src = torch.randn(2, 64, 6, 7)
+pos = torch.randn(2, 64, 6, 7)
+mask = torch.zeros(2, 6, 7, dtype=torch.bool)
+mask[1, :, 5:] = True
+query = torch.randn(10, 64)
+with torch.no_grad():
+    ref = transformer(src, mask, query, pos)[0]
+    drop_aux_outputs(SimpleNamespace(transformer=transformer))
+    out = transformer(src, mask, query, pos)[0]
+print(f'last layer max abs diff : {(ref[-1] - out[-1]).abs().max():.2e}')
+assert out.shape[0] == 1
+assert torch.allclose(ref[-1], out[-1], atol=1e-5)
+
+# * fuse_input_normalization vs normalize then conv, on ResNet's conv1
+ref_conv = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3, bias=False)
+fused_conv = copy.deepcopy(ref_conv)
+fuse_input_normalization(
+    SimpleNamespace(backbone=[SimpleNamespace(body=SimpleNamespace(
+        conv1=fused_conv))]), IMAGENET_MEAN, IMAGENET_STD)
+pixels = torch.randint(0, 256, (2, 3, 64, 80)).float()
+mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+std = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1)
+# the fused conv has no padding; it gets a mean-pixel border instead
+b = FUSED_BORDER
+bordered = (mean * 255.0).repeat(2, 1, 64 + 2 * b, 80 + 2 * b)
+bordered[..., b:-b, b:-b] = pixels
+with torch.no_grad():
+    ref = ref_conv((pixels / 255.0 - mean) / std)
+    out = fused_conv(bordered)
+print(f'fuse max abs diff : {(ref - out).abs().max():.2e}')
+assert torch.allclose(ref, out, atol=1e-4)
+
+# in bfloat16 the raw inputs cancel against the large folded bias; that
+# must not cost much more accuracy than normalizing does
+with torch.no_grad(), torch.autocast(device_type='cpu',
+                                     dtype=torch.bfloat16):
+    ref_bf16 = ref_conv((pixels / 255.0 - mean) / std).float()
+    out_bf16 = fused_conv(bordered).float()
+ref_err = (ref_bf16 - ref).abs().max()
+fuse_err = (out_bf16 - ref).abs().max()
+print(f'bf16 max abs err : {ref_err:.2e} unfused, {fuse_err:.2e} fused')
+assert fuse_err < 2 * ref_err
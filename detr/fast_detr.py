@@ -0,0 +1,255 @@
+'''
+Inference-oriented variants of the DETR modules.
+'''
+import math
+import os
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from DETR.util.misc import NestedTensor
+from DETR.models.position_encoding import PositionEmbeddingSine
+
+
+class DETRExport(nn.Module):
+    """Tensor in / tensor out wrapper around DETR for export and tracing."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, img, mask):
+        outputs = self.model(NestedTensor(tensors=img, mask=mask))
+        return outputs['pred_logits'], outputs['pred_boxes']
+
+
+class SDPAMultiheadAttention(nn.MultiheadAttention):
+    """nn.MultiheadAttention computed with F.scaled_dot_product_attention.
+
+    Unlike the reference implementation it never materializes the attention
+    weights, so the fused flash / memory-efficient kernels can be used. Only
+    the inference case DETR needs is handled; anything else falls back to
+    the parent forward.
+    """
+    def forward(self,
+                query,
+                key,
+                value,
+                key_padding_mask=None,
+                need_weights=True,
+                attn_mask=None,
+                **kwargs):
+        if (self.training or attn_mask is not None or kwargs
+                or self.batch_first or not self._qkv_same_embed_dim
+                or self.bias_k is not None or self.add_zero_attn):
+            return super().forward(query,
+                                   key,
+                                   value,
+                                   key_padding_mask=key_padding_mask,
+                                   need_weights=need_weights,
+                                   attn_mask=attn_mask,
+                                   **kwargs)
+        tgt_len, bsz, embed_dim = query.shape
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3)
+        b_q = b_k = b_v = None
+        if self.in_proj_bias is not None:
+            b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+
+        # (L, B, E) -> (B, H, L, D)
+        def split_heads(x, w, b):
+            x = F.linear(x, w, b)
+            return x.view(x.shape[0], bsz, self.num_heads,
+                          self.head_dim).permute(1, 2, 0, 3)
+
+        q = split_heads(query, w_q, b_q)
+        k = split_heads(key, w_k, b_k)
+        v = split_heads(value, w_v, b_v)
+        mask = None
+        if key_padding_mask is not None:
+            # SDPA's boolean mask is True where attention is allowed
+            mask = ~key_padding_mask.to(torch.bool)[:, None, None, :]
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        out = out.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        return self.out_proj(out), None
+
+
+def use_sdpa(model):
+    """Switch every nn.MultiheadAttention in `model` to SDPA in place."""
+    for module in model.modules():
+        if type(module) is nn.MultiheadAttention:
+            module.__class__ = SDPAMultiheadAttention
+    return model
+
+
+class FastPositionEmbeddingSine(PositionEmbeddingSine):
+    """PositionEmbeddingSine with precomputed frequencies and a single sin.
+
+    The frequencies are non-persistent buffers instead of being rebuilt
+    every forward, and the interleaved sin / cos pairs are computed as one
+    sin with a pi/2 phase on the odd channels, which avoids the stack.
+    The embedding itself depends on the padding mask, so it is not cached.
+    """
+    def forward(self, tensor_list: NestedTensor):
+        mask = tensor_list.mask
+        assert mask is not None
+        not_mask = ~mask
+        y_embed = not_mask.cumsum(1, dtype=torch.float32)
+        x_embed = not_mask.cumsum(2, dtype=torch.float32)
+        if self.normalize:
+            eps = 1e-6
+            y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
+            x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
+        pos_x = torch.sin(x_embed[:, :, :, None] * self.inv_dim_t + self.phase)
+        pos_y = torch.sin(y_embed[:, :, :, None] * self.inv_dim_t + self.phase)
+        return torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
+
+
+def use_fast_position_embedding(model):
+    """Switch the sine position embedding of `model` in place."""
+    for module in model.modules():
+        if type(module) is PositionEmbeddingSine:
+            device = next(model.parameters()).device
+            dim_t = torch.arange(module.num_pos_feats,
+                                 dtype=torch.float32,
+                                 device=device)
+            dim_t = module.temperature**(2 * (dim_t // 2) /
+                                         module.num_pos_feats)
+            phase = (torch.arange(module.num_pos_feats, device=device) %
+                     2) * (math.pi / 2)
+            module.__class__ = FastPositionEmbeddingSine
+            module.register_buffer('inv_dim_t', 1 / dim_t, persistent=False)
+            module.register_buffer('phase', phase, persistent=False)
+    return model
+
+
+def drop_aux_outputs(model):
+    """Make `model` build only the last decoder layer's predictions.
+
+    The per-layer (auxiliary) outputs only feed the training loss; without
+    them the decoder returns just its normalized final output, so the
+    prediction heads run on one layer instead of all of them.
+    """
+    model.aux_loss = False
+    model.transformer.decoder.return_intermediate = False
+    return model
+
+
+@torch.no_grad()
+def fuse_input_normalization(model, mean, std, scale=255.0):
+    """Fold `(x / scale - mean) / std` into the backbone's first conv.
+
+    Afterwards the model takes raw 0-scale inputs. Zero padding would now
+    stand for a black rather than a mean pixel, so the conv's padding is
+    removed and inputs must instead carry a border of that width filled
+    with the mean pixel (inference_data.pad_to_bucket with normalize=False).
+    """
+    conv1 = model.backbone[0].body.conv1
+    weight = conv1.weight
+    mean = torch.as_tensor(mean, dtype=weight.dtype, device=weight.device)
+    std = torch.as_tensor(std, dtype=weight.dtype, device=weight.device)
+    bias = -(weight * (mean / std).view(1, -1, 1, 1)).sum(dim=(1, 2, 3))
+    if conv1.bias is not None:
+        bias += conv1.bias
+    conv1.weight.copy_(weight / (scale * std).view(1, -1, 1, 1))
+    conv1.bias = nn.Parameter(bias, requires_grad=False)
+    conv1.padding = (0, 0)
+    return model
+
+
+def _clone_outputs(outputs):
+    if isinstance(outputs, dict):
+        return {k: _clone_outputs(v) for k, v in outputs.items()}
+    if isinstance(outputs, list):
+        return [_clone_outputs(v) for v in outputs]
+    return outputs.clone()
+
+
+class CUDAGraphRunner:
+    """Replays a CUDA graph of `model`'s forward, captured once per shape.
+
+    Launching the forward costs a single graph launch instead of hundreds of
+    kernels. The inputs a shape is captured with become its static buffers,
+    so callers should pass persistent tensors refilled in place; replays
+    with those tensors need no copy, other inputs are copied in first.
+    The returned outputs are the static buffers themselves, overwritten by
+    the next replay, unless `clone` is set.
+    """
+    def __init__(self, model, amp=False, num_warmup=3, clone=False):
+        self.model = model
+        self.amp = amp
+        self.clone = clone
+        self.num_warmup = num_warmup
+        self.graphs = {}
+
+    def _forward(self, samples):
+        # the autocast weight cache must not outlive the capture
+        with torch.autocast(device_type='cuda',
+                            dtype=torch.bfloat16,
+                            enabled=self.amp,
+                            cache_enabled=False):
+            return self.model(samples)
+
+    def _capture(self, static_in, static_mask):
+        # built once; replays only refresh the buffers it wraps
+        samples = NestedTensor(tensors=static_in, mask=static_mask)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup):
+                self._forward(samples)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self._forward(samples)
+        return static_in, static_mask, graph, static_out
+
+    @torch.inference_mode()
+    def __call__(self, img, mask):
+        shape = tuple(img.shape)
+        if shape not in self.graphs:
+            self.graphs[shape] = self._capture(img, mask)
+        static_in, static_mask, graph, static_out = self.graphs[shape]
+        if img is not static_in:
+            static_in.copy_(img, non_blocking=True)
+        if mask is not static_mask:
+            static_mask.copy_(mask, non_blocking=True)
+        graph.replay()
+        if self.clone:
+            return _clone_outputs(static_out)
+        return static_out
+
+
+class JITRunner:
+    """Runs TorchScript traces of `model`, one per input shape.
+
+    DETR's forward bakes the input size into the trace (e.g. the mask
+    interpolation), so each shape gets its own frozen, inference-optimized
+    trace, saved as `save_dir/detr_<tag>_<device>_<shape>.ts` and loaded on
+    later runs (optimize_for_inference output is device specific). Weights
+    and model options are frozen into the trace, so `tag` must identify
+    them (see model_tag in test.py).
+    """
+    def __init__(self, model, tag, save_dir):
+        self.model = DETRExport(model).eval()
+        self.tag = tag
+        self.save_dir = save_dir
+        self.traced = {}
+
+    def _load(self, img, mask):
+        shape = 'x'.join(map(str, img.shape))
+        path = os.path.join(self.save_dir,
+                            f'detr_{self.tag}_{img.device.type}_{shape}.ts')
+        if os.path.exists(path):
+            return torch.jit.load(path, map_location=img.device)
+        traced = torch.jit.trace(self.model, (img, mask), strict=False)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        torch.jit.save(traced, path)
+        return traced
+
+    @torch.no_grad()
+    def __call__(self, img, mask):
+        shape = tuple(img.shape)
+        if shape not in self.traced:
+            self.traced[shape] = self._load(img, mask)
+        pred_logits, pred_boxes = self.traced[shape](img, mask)
+        return {'pred_logits': pred_logits, 'pred_boxes': pred_boxes}
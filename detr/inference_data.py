@@ -0,0 +1,130 @@
+'''
+Input pipeline for DETR inference: raw JPEG reading, bucketing and padding.
+'''
+import os
+from functools import lru_cache
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+from torchvision.io import ImageReadMode, decode_jpeg, read_file
+
+# fixed (H, W) shapes inference images are padded to, so that the compiled
+# graph is only specialized a handful of times; COCO images are at most
+# 640px on each side
+BUCKETS = [(480, 640), (640, 480), (640, 640)]
+
+# normalization DETR was trained with, on [0, 1] RGB inputs
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# mean-pixel border pad_to_bucket adds with normalize=False; it replaces the
+# zero padding of ResNet's 7x7 conv1, which fuse_input_normalization removes
+FUSED_BORDER = 3
+
+
+@lru_cache()
+def _channel_stats(device):
+    mean = torch.tensor(IMAGENET_MEAN, device=device).view(3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=device).view(3, 1, 1)
+    return mean, std
+
+
+def list_images(img_dir, prefix=''):
+    """Paths of the .jpg files in `img_dir` whose name starts with `prefix`.
+
+    A single os.scandir pass with plain string checks, instead of glob's
+    per-entry fnmatch.
+    """
+    with os.scandir(img_dir) as it:
+        return [
+            entry.path for entry in it
+            if entry.name.startswith(prefix) and entry.name.endswith('.jpg')
+        ]
+
+
+def get_bucket(h, w):
+    """Return the bucket (H, W) for an h x w image and its size inside it.
+
+    This is the smallest bucket containing the image. Images larger than
+    every bucket are scaled down, keeping the aspect ratio, to fit the bucket
+    that needs the least shrinking.
+    """
+    fits = [(bh, bw) for bh, bw in BUCKETS if bh >= h and bw >= w]
+    if fits:
+        return min(fits, key=lambda b: b[0] * b[1]), (h, w)
+    bucket = max(BUCKETS, key=lambda b: min(b[0] / h, b[1] / w))
+    scale = min(bucket[0] / h, bucket[1] / w)
+    size = (min(bucket[0], round(h * scale)), min(bucket[1], round(w * scale)))
+    return bucket, size
+
+
+def pad_to_bucket(img, normalize=True):
+    """Normalize a decoded (3, h, w) uint8 image and pad it to its bucket.
+
+    Returns a (1, 3, H, W) float tensor and a (1, H, W) mask that is True on
+    padding, following DETR's NestedTensor convention. With normalize=False
+    the raw 0-255 values are kept and the padding is filled with the mean
+    pixel instead of zero, for models whose first conv folds in the
+    normalization (see fast_detr.fuse_input_normalization). The tensor then
+    also gets a FUSED_BORDER mean-pixel border on every side, standing in
+    for that conv's padding, and is (1, 3, H + 2 * FUSED_BORDER, ...).
+    """
+    _, h, w = img.shape
+    bucket, (h, w) = get_bucket(h, w)
+    if (h, w) != tuple(img.shape[-2:]):
+        img = F.interpolate(img[None].float(),
+                            size=(h, w),
+                            mode='bilinear',
+                            align_corners=False,
+                            antialias=True)[0]
+    mean, std = _channel_stats(img.device)
+    b = 0 if normalize else FUSED_BORDER
+    img_th = torch.empty(1,
+                         3,
+                         bucket[0] + 2 * b,
+                         bucket[1] + 2 * b,
+                         dtype=torch.float32,
+                         device=img.device)
+    if normalize:
+        img_th.zero_()
+        img_th[0, :, :h, :w].copy_(img).div_(255.0).sub_(mean).div_(std)
+    else:
+        img_th.copy_(mean * 255.0)
+        img_th[0, :, b:b + h, b:b + w].copy_(img)
+    mask = torch.ones(1, *bucket, dtype=torch.bool, device=img.device)
+    mask[:, :h, :w] = False
+    return img_th, mask
+
+
+def calibration_batches(img_paths,
+                        device,
+                        shape,
+                        num_images=100,
+                        normalize=True):
+    """Yield up to `num_images` padded (img, mask) pairs of bucket `shape`."""
+    count = 0
+    for img_path in img_paths:
+        img = decode_jpeg(read_file(img_path),
+                          mode=ImageReadMode.RGB,
+                          device=device)
+        img_th, mask_th = pad_to_bucket(img, normalize=normalize)
+        if tuple(mask_th.shape[-2:]) != shape:
+            continue
+        yield img_th, mask_th
+        count += 1
+        if count == num_images:
+            return
+
+
+class ImageDataset(Dataset):
+    """Reads the raw JPEG bitstreams; decoding happens on the device."""
+    def __init__(self, img_paths):
+        self.img_paths = img_paths
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        img_path = self.img_paths[idx]
+        return img_path, read_file(img_path)
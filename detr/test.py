@@ -1,27 +1,15 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import os
 import argparse
+import hashlib
 import random
 from pathlib import Path
 import sys
-import glob
+import logging
 
 sys.path.append("./DETR")
-import numpy as np
-import cv2
-import torch
-from torchvision import transforms
-from torch.utils.data import DataLoader, DistributedSampler
-
-import DETR.datasets
-import DETR.util.misc as utils
-from DETR.datasets import build_dataset, get_coco_api_from_dataset
-from DETR.engine import evaluate, train_one_epoch
-from DETR.models import build_model
-from DETR.models.backbone import build_backbone
-from DETR.models.matcher import build_matcher
-from DETR.models.transformer import build_transformer
-from DETR.models.detr import DETR as DETRModel
+
+logger = logging.getLogger(__name__)
 
 
 def get_args_parser():
@@ -157,6 +145,49 @@ def get_args_parser():
                         help='start epoch')
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--num_workers', default=2, type=int)
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help="Log per-batch details and print the model after the run")
+
+    # inference parameters
+    parser.add_argument(
+        '--no_compile',
+        dest='compile',
+        action='store_false',
+        help="Disables torch.compile of the model for inference")
+    parser.add_argument(
+        '--no_amp',
+        dest='amp',
+        action='store_false',
+        help="Disables bfloat16 autocast during inference")
+    parser.add_argument(
+        '--no_sdpa',
+        dest='sdpa',
+        action='store_false',
+        help="Keeps the reference attention instead of "
+        "scaled_dot_product_attention")
+    parser.add_argument(
+        '--fuse_normalize',
+        action='store_true',
+        help="Fold the input /255 and mean/std normalization into the "
+        "backbone's first conv (inference only)")
+    # alternative inference backends, used instead of torch.compile
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument(
+        '--jit',
+        action='store_true',
+        help="Run frozen TorchScript traces of the model instead of "
+        "torch.compile, avoiding its first-call compile cost")
+    backend.add_argument(
+        '--cuda_graph',
+        action='store_true',
+        help="Capture the forward in CUDA graphs instead of using "
+        "torch.compile")
+    backend.add_argument(
+        '--trt',
+        action='store_true',
+        help="Run inference with an INT8 TensorRT engine built from the model")
 
     # distributed training parameters
     parser.add_argument('--world_size',
@@ -169,7 +200,58 @@ def get_args_parser():
     return parser
 
 
+def model_tag(args):
+    """Name fragment identifying the checkpoint and the model options.
+
+    Used to key cached exports / traces, which have both baked in.
+    """
+    checkpoint = args.resume
+    if checkpoint and os.path.exists(checkpoint):
+        stat = os.stat(checkpoint)
+        checkpoint = (f'{os.path.abspath(checkpoint)}:{stat.st_size}:'
+                      f'{stat.st_mtime_ns}')
+    options = [
+        checkpoint, args.backbone, args.dilation, args.position_embedding,
+        args.enc_layers, args.dec_layers, args.dim_feedforward,
+        args.hidden_dim, args.nheads, args.num_queries, args.pre_norm,
+        args.dataset_file, args.sdpa
+    ]
+    digest = hashlib.sha1(repr(options).encode()).hexdigest()[:12]
+    norm = 'fused_border' if args.fuse_normalize else 'norm'
+    return f'{norm}_{digest}'
+
+
+def artifact_dir(args):
+    """Directory for cached exports / traces, created if needed.
+
+    --output_dir if given, else a per-user cache directory, so that the
+    artifacts never land in the source tree.
+    """
+    path = args.output_dir or os.path.join(os.path.expanduser('~'), '.cache',
+                                           'detr_inference')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 def main(args):
+    # heavy imports are deferred so that e.g. --help does not load torch
+    import numpy as np
+    import torch
+    from torch.utils.data import DataLoader
+    from torchvision.io import ImageReadMode, decode_jpeg
+
+    import DETR.util.misc as utils
+    from DETR.models.backbone import build_backbone
+    from DETR.models.detr import DETR as DETRModel
+    from DETR.models.transformer import build_transformer
+    from fast_detr import (CUDAGraphRunner, JITRunner, drop_aux_outputs,
+                           fuse_input_normalization,
+                           use_fast_position_embedding, use_sdpa)
+    from inference_data import (BUCKETS, FUSED_BORDER, IMAGENET_MEAN,
+                                IMAGENET_STD, ImageDataset,
+                                calibration_batches, list_images,
+                                pad_to_bucket)
+
     # fix the seed for reproducibility
     seed = args.seed + utils.get_rank()
     torch.manual_seed(seed)
@@ -180,7 +262,7 @@ def main(args):
 
     transformer = build_transformer(args)
     num_classes = 20 if args.dataset_file != 'coco' else 91
-    print(f'args : {args}')
+    logger.info('args : %s', args)
     model = DETRModel(
         backbone,
         transformer,
@@ -203,29 +285,142 @@ def main(args):
             lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
             args.start_epoch = checkpoint['epoch'] + 1
 
-    img_paths = glob.glob(
-        os.path.join(args.coco_path, 'val2017', '000000229*jpg'))
-    for img_path in img_paths:
-        img = cv2.imread(img_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        # img = img.transpose(2, 0, 1)
-        # img = np.ascontiguousarray(img, dtype=np.float32)
-        # img /= 255.0
-        # img = img[np.newaxis, :, :, :]
-
-        img_th = transforms.ToTensor()(img)
-        img_th = img_th.unsqueeze(0)
-        print(f'img : {img_th.shape}')
-        outputs = model(utils.NestedTensor(tensors=img_th, mask=None))
-        print(type(outputs))
-        # model_without_ddp
-    print(model)
+    device = torch.device(args.device)
+    model.eval()
+    drop_aux_outputs(model)
+    model.to(device)
+    use_fast_position_embedding(model)
+    if args.sdpa:
+        use_sdpa(model)
+    if args.fuse_normalize:
+        fuse_input_normalization(model, IMAGENET_MEAN, IMAGENET_STD)
+    normalize = not args.fuse_normalize
+
+    runner = None
+    if args.trt:
+        import trt_infer
+        if trt_infer.trt is None or device.type != 'cuda':
+            logger.warning(
+                'TensorRT is not available, running the PyTorch model')
+        else:
+            calib_paths = sorted(
+                list_images(os.path.join(args.coco_path, 'val2017')))
+            runner = trt_infer.build_runner(
+                model, artifact_dir(args), model_tag(args), BUCKETS,
+                args.batch_size,
+                calibration_batches(calib_paths,
+                                    device,
+                                    BUCKETS[0],
+                                    normalize=normalize),
+                device,
+                border=0 if normalize else FUSED_BORDER)
+
+    # TensorRT takes NCHW inputs; the PyTorch paths run the backbone in NHWC
+    channels_last = runner is None
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+
+    amp_enabled = args.amp and device.type == 'cuda'
+    if args.jit:
+        runner = JITRunner(model, model_tag(args), artifact_dir(args))
+    if args.cuda_graph:
+        if device.type != 'cuda':
+            logger.warning('CUDA graphs need a CUDA device, running the '
+                           'PyTorch model')
+        else:
+            runner = CUDAGraphRunner(model, amp=amp_enabled)
+
+    # inputs come in a few fixed bucket shapes, so autotuning pays off once
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+    compiled = runner is None and args.compile
+    if compiled:
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
+    img_paths = list_images(os.path.join(args.coco_path, 'val2017'),
+                            prefix='000000229')
+    # read files in worker processes while the device runs the previous image
+    loader_kwargs = {}
+    if args.num_workers > 0:
+        loader_kwargs = dict(prefetch_factor=2, persistent_workers=True)
+    data_loader = DataLoader(ImageDataset(img_paths),
+                             batch_size=None,
+                             num_workers=args.num_workers,
+                             **loader_kwargs)
+    warmup = compiled
+    memory_format = (torch.channels_last
+                     if channels_last else torch.contiguous_format)
+    # one persistent NestedTensor per batch shape, refilled in place; the
+    # CUDA graph runner captures directly on its buffers
+    inputs = {}
+
+    def run_batch(batch):
+        nonlocal warmup
+        paths = [img_path for img_path, _, _ in batch]
+        # with --fuse_normalize the images carry a border the mask lacks
+        shape = (len(batch), 3, *batch[0][1].shape[-2:])
+        if shape not in inputs:
+            inputs[shape] = utils.NestedTensor(
+                tensors=torch.empty(shape,
+                                    device=device,
+                                    memory_format=memory_format),
+                mask=torch.empty(len(batch),
+                                 *batch[0][2].shape[-2:],
+                                 dtype=torch.bool,
+                                 device=device))
+        samples = inputs[shape]
+        for i, (_, img_th, mask_th) in enumerate(batch):
+            samples.tensors[i].copy_(img_th[0])
+            samples.mask[i].copy_(mask_th[0])
+        logger.debug('img : %s', samples.tensors.shape)
+        if runner is not None:
+            outputs = runner(samples.tensors, samples.mask)
+        else:
+            with torch.inference_mode(), torch.autocast(
+                    device_type=device.type,
+                    dtype=torch.bfloat16,
+                    enabled=amp_enabled):
+                if warmup:
+                    # absorb the compile cost before the first real forward
+                    model(samples)
+                    warmup = False
+                outputs = model(samples)
+        # recover the per-image predictions from the batched outputs; with
+        # --cuda_graph they are only valid until the next batch runs
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, img_path in enumerate(paths):
+                pred_logits = outputs['pred_logits'][i]
+                pred_boxes = outputs['pred_boxes'][i]
+                logger.debug('%s : %s %s', img_path, pred_logits.shape,
+                             pred_boxes.shape)
+
+    # images are batched per bucket, so every batch shares one shape
+    batches = {}
+    for img_path, raw in data_loader:
+        # nvJPEG decodes straight into device memory when device is cuda
+        img = decode_jpeg(raw, mode=ImageReadMode.RGB, device=device)
+        img_th, mask_th = pad_to_bucket(img, normalize=normalize)
+        batch = batches.setdefault(tuple(img_th.shape[-2:]), [])
+        batch.append((img_path, img_th, mask_th))
+        if len(batch) == args.batch_size:
+            run_batch(batch)
+            batch.clear()
+    for batch in batches.values():
+        if batch:
+            run_batch(batch)
+    if args.verbose:
+        print(model)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser('DETR training and evaluation script',
                                      parents=[get_args_parser()])
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
     if args.output_dir:
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
     main(args)
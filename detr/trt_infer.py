@@ -0,0 +1,207 @@
+'''
+INT8 TensorRT inference for DETR.
+
+The model is exported to ONNX once, built into an INT8 engine calibrated on
+a few validation images and cached next to the ONNX file, both keyed on the
+checkpoint and input normalization.
+'''
+import os
+
+import torch
+
+from fast_detr import DETRExport
+
+try:
+    import tensorrt as trt
+except ImportError:
+    trt = None
+
+INPUT_NAMES = ['img', 'mask']
+OUTPUT_NAMES = ['pred_logits', 'pred_boxes']
+
+
+def _img_shape(shape, border):
+    return (shape[0] + 2 * border, shape[1] + 2 * border)
+
+
+def export_onnx(model, onnx_path, shape, device, border=0):
+    img = torch.zeros(1, 3, *_img_shape(shape, border), device=device)
+    mask = torch.zeros(1, *shape, dtype=torch.bool, device=device)
+    torch.onnx.export(DETRExport(model).eval(), (img, mask),
+                      onnx_path,
+                      opset_version=17,
+                      input_names=INPUT_NAMES,
+                      output_names=OUTPUT_NAMES,
+                      dynamic_axes={
+                          'img': {
+                              0: 'batch',
+                              2: 'img_h',
+                              3: 'img_w'
+                          },
+                          'mask': {
+                              0: 'batch',
+                              1: 'h',
+                              2: 'w'
+                          }
+                      })
+
+
+if trt is not None:
+
+    class EntropyCalibrator(trt.IInt8EntropyCalibrator2):
+        """Feeds (img, mask) CUDA tensors to the TensorRT INT8 calibrator."""
+        def __init__(self, batches, cache_path):
+            trt.IInt8EntropyCalibrator2.__init__(self)
+            self.batches = iter(batches)
+            self.cache_path = cache_path
+            # keep the current batch alive while TensorRT reads it
+            self.current = None
+
+        def get_batch_size(self):
+            return 1
+
+        def get_batch(self, names):
+            try:
+                img, mask = next(self.batches)
+            except StopIteration:
+                return None
+            self.current = {'img': img.contiguous(), 'mask': mask.contiguous()}
+            return [self.current[name].data_ptr() for name in names]
+
+        def read_calibration_cache(self):
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, 'rb') as f:
+                    return f.read()
+            return None
+
+        def write_calibration_cache(self, cache):
+            with open(self.cache_path, 'wb') as f:
+                f.write(cache)
+
+
+def load_engine(engine_path):
+    """Deserialize a cached engine; None if it is missing or unusable."""
+    if not os.path.exists(engine_path):
+        return None
+    runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+    with open(engine_path, 'rb') as f:
+        return runtime.deserialize_cuda_engine(f.read())
+
+
+def build_engine(onnx_path,
+                 engine_path,
+                 shapes,
+                 max_batch,
+                 calib_batches,
+                 border=0):
+    """Build an INT8 engine for the given input shapes and cache it.
+
+    `shapes` are the (H, W) buckets the engine must accept, with batches of
+    up to `max_batch` images; calibration runs on single images at the first
+    bucket, so `calib_batches` must yield tensors of that shape. Images are
+    `border` pixels larger than their mask on every side.
+    """
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(
+        1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    with open(onnx_path, 'rb') as f:
+        if not parser.parse(f.read()):
+            errors = '\n'.join(
+                str(parser.get_error(i)) for i in range(parser.num_errors))
+            raise RuntimeError(f'failed to parse {onnx_path}:\n{errors}')
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.INT8)
+    # layers without an INT8 implementation fall back to FP16
+    config.set_flag(trt.BuilderFlag.FP16)
+    config.int8_calibrator = EntropyCalibrator(
+        calib_batches,
+        os.path.splitext(engine_path)[0] + '.cache')
+
+    min_hw = (min(h for h, _ in shapes), min(w for _, w in shapes))
+    max_hw = (max(h for h, _ in shapes), max(w for _, w in shapes))
+    profile = builder.create_optimization_profile()
+    profile.set_shape('img', (1, 3, *_img_shape(min_hw, border)),
+                      (1, 3, *_img_shape(shapes[0], border)),
+                      (max_batch, 3, *_img_shape(max_hw, border)))
+    profile.set_shape('mask', (1, *min_hw), (1, *shapes[0]),
+                      (max_batch, *max_hw))
+    config.add_optimization_profile(profile)
+    config.set_calibration_profile(profile)
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise RuntimeError('failed to build TensorRT engine')
+    with open(engine_path, 'wb') as f:
+        f.write(serialized)
+    engine = trt.Runtime(logger).deserialize_cuda_engine(serialized)
+    if engine is None:
+        raise RuntimeError('failed to deserialize the built TensorRT engine')
+    return engine
+
+
+class TRTRunner:
+    """Runs a DETR engine on CUDA tensors, returning DETR-style outputs.
+
+    Output buffers are allocated once per input shape and reused.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.context = engine.create_execution_context()
+        self.outputs = {}
+
+    def __call__(self, img, mask):
+        shape = tuple(img.shape)
+        img = img.contiguous()
+        mask = mask.contiguous()
+        if not (self.context.set_input_shape('img', shape)
+                and self.context.set_input_shape('mask', tuple(mask.shape))):
+            raise ValueError(
+                f'input shape {shape} is outside the TensorRT engine profile')
+        if shape not in self.outputs:
+            self.outputs[shape] = {
+                name: torch.empty(tuple(self.context.get_tensor_shape(name)),
+                                  dtype=torch.float32,
+                                  device=img.device)
+                for name in OUTPUT_NAMES
+            }
+        outputs = self.outputs[shape]
+        self.context.set_tensor_address('img', img.data_ptr())
+        self.context.set_tensor_address('mask', mask.data_ptr())
+        for name, out in outputs.items():
+            self.context.set_tensor_address(name, out.data_ptr())
+        if not self.context.execute_async_v3(
+                torch.cuda.current_stream().cuda_stream):
+            raise RuntimeError('TensorRT inference failed')
+        return outputs
+
+
+def build_runner(model,
+                 output_dir,
+                 tag,
+                 shapes,
+                 max_batch,
+                 calib_batches,
+                 device,
+                 border=0):
+    """Export `model` and return a TRTRunner for its INT8 engine.
+
+    `tag` identifies the checkpoint and input normalization (including
+    `border`, see inference_data.pad_to_bucket); the ONNX file, engine and
+    calibration cache are only reused for the same tag. The engine's
+    profile is also keyed on the bucket shapes and batch size.
+    """
+    onnx_path = os.path.join(output_dir, f'detr_{tag}.onnx')
+    shapes_key = '-'.join(f'{h}x{w}' for h, w in shapes)
+    engine_path = os.path.join(
+        output_dir, f'detr_{tag}_int8_b{max_batch}_{shapes_key}.engine')
+    engine = load_engine(engine_path)
+    if engine is None:
+        # missing, or stale / built by an incompatible TensorRT: rebuild
+        if not os.path.exists(onnx_path):
+            export_onnx(model, onnx_path, shapes[0], device, border)
+        engine = build_engine(onnx_path, engine_path, shapes, max_batch,
+                              calib_batches, border)
+    return TRTRunner(engine)